@@ -1,11 +1,12 @@
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Union
 
 import yaml
 try:
-    from yaml import CLoader as Loader
+    from yaml import CSafeLoader as Loader
 except ImportError:
-    from yaml import Loader
+    from yaml import SafeLoader as Loader  # type: ignore
 
 
 CONFIG_DIRECTORY = Path(__file__).parents[1]
@@ -13,10 +14,22 @@ CONFIG_FILE = CONFIG_DIRECTORY / 'config.yml'
 DATA_DIRECTORY = CONFIG_DIRECTORY / 'data'
 
 
+@lru_cache(maxsize=None)
+def _load(config_file: Path, mtime: int) -> Dict:
+    """
+    Parse YAML config file.
+
+    The modification time is part of the cache key, such that edits to the
+    file are picked up without restarting the interpreter.
+    """
+    with open(config_file, 'r') as file:
+        return yaml.load(file, Loader=Loader)
+
+
 class Config:
-    def __init__(self, config_file: Path = CONFIG_FILE) -> None:
-        with open(config_file, 'r') as file:
-            self.yaml = yaml.load(file, Loader=Loader)
+    def __init__(self, config_file: Union[str, Path] = CONFIG_FILE) -> None:
+        config_file = Path(config_file).resolve()
+        self.yaml = _load(config_file, config_file.stat().st_mtime_ns)
 
     def __getitem__(self, key):
         return self.yaml[key]
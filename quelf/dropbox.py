@@ -1,18 +1,22 @@
+from functools import lru_cache
 from pathlib import Path
-from dropbox import Dropbox  # type: ignore
 
-from .config import Config
+from .config import config as conf
 
-conf = Config()
 
-dbx = Dropbox(conf['dropbox']['access_token'])
+@lru_cache(maxsize=None)
+def client():
+    """Return Dropbox API client, importing the dropbox SDK on first use."""
+    from dropbox import Dropbox  # type: ignore
+
+    return Dropbox(conf['dropbox']['access_token'])
 
 
 class File:
     def __init__(self, file_path: str) -> None:
         self.path = Path(__file__).parents[1] / 'data' / file_path
 
-        dbx.files_download_to_file(
+        client().files_download_to_file(
             download_path=self.path,
             path='/' + file_path,
         )
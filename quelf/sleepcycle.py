@@ -1,163 +1,488 @@
-import json
+import atexit
+import logging
+import os
+import queue
 import re
+import shutil
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 from pathlib import Path
 from typing import (
+    AbstractSet,
     Any,
     Dict,
     Generator,
     Iterable,
     Iterator,
     List,
+    Mapping,
     Optional,
+    Set,
+    TYPE_CHECKING,
     Tuple,
     Union,
 )
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile
 
-import pandas as pd
-import progressbar
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from mypy_extensions import TypedDict
 
 from .config import config, DATA_DIRECTORY
 
+if TYPE_CHECKING:
+    # pandas takes a considerable amount of time to import, so it is only
+    # imported when data frames are actually constructed.
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
 BASE_URL = 'https://s.sleepcycle.com'
 SLEEP_CYCLE_LOGIN_URL = BASE_URL + '/site/login'
 SLEEP_CYCLE_DATA_URL = BASE_URL + '/export/original'
 
 ZIP_FILE = DATA_DIRECTORY / 'sleepcycle_data.zip'
 JSON_FILE = DATA_DIRECTORY / 'data_json.txt'
+PARQUET_FILE = DATA_DIRECTORY / 'data_json.parquet'
+
+# Sleep session IDs embedded as javascript variables in the SleepSecure pages
+SLEEPSESSION_ID_PATTERN = re.compile(
+    rb"var (first|last)_sleepsession_id = '(\d+)'",
+)
+
+# Size of each downloaded chunk and number of concurrent range requests
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_WORKERS = 8
+
+# Number of sleep sessions to fetch ahead of the ones being processed
+PREFETCH_SIZE = 16
+
+# ISO 8601 formatted fields of SleepSessionJSON
+SLEEP_SESSION_DATETIME_FIELDS = (
+    'start_local',
+    'stop_local',
+    'start_global',
+    'stop_global',
+    'window_start',
+    'window_stop',
+    'window_offset_start',
+    'window_offset_stop',
+)
+
+
+# Room for both a full and a few column selected loads of the export, such
+# that alternating between them does not evict the cached data frames.
+@lru_cache(maxsize=8)
+def _load_export(
+    source: Path,
+    mtime: int,
+    columns: Optional[Tuple[str, ...]] = None,
+) -> 'pd.DataFrame':
+    """
+    Parse exported JSON data from `source` into pandas DataFrame.
+
+    The modification time is part of the cache key, such that a new export is
+    picked up without restarting the interpreter, while all SleepCycle
+    instances share the parsed data of an unchanged export.
+
+    Only `columns` are read from the Parquet cache if specified. The Parquet
+    cache itself is always written with all columns.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
+    if (
+        PARQUET_FILE.is_file()
+        and PARQUET_FILE.stat().st_mtime >= source.stat().st_mtime
+    ):
+        # The table is converted with Arrow types directly. pandas can not
+        # reconstruct the nested list columns from the stored pandas metadata
+        # when only some of the columns are read.
+        table = pq.read_table(
+            PARQUET_FILE,
+            columns=list(columns) if columns is not None else None,
+        )
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    if source == ZIP_FILE:
+        with ZipFile(ZIP_FILE, 'r') as zip_file:
+            raw_json = zip_file.read(JSON_FILE.name)
+    else:
+        raw_json = JSON_FILE.read_bytes()
+
+    # The records are converted directly into Arrow columns, which keeps
+    # strings in contiguous buffers instead of as one Python object per
+    # row. Fields with values of mixed types can not be represented as
+    # Arrow columns, in which case pandas has to infer the column types.
+    records = orjson.loads(raw_json)
+    del raw_json
+    if not records:
+        # No field types can be inferred from an empty export
+        data = pd.DataFrame(columns=['start', 'stop'])
+    else:
+        try:
+            table = pa.Table.from_struct_array(pa.array(records))
+            data = table.to_pandas(types_mapper=pd.ArrowDtype)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            data = pd.DataFrame.from_records(records)
+
+    for column in ('start', 'stop'):
+        data[column] = pd.to_datetime(data[column], cache=True)
+    data = data.convert_dtypes(dtype_backend='pyarrow')
+
+    try:
+        data.to_parquet(PARQUET_FILE, compression='zstd')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed-type columns can not be cached, so we parse the JSON
+        # data again the next time.
+        PARQUET_FILE.unlink(missing_ok=True)
+
+    if columns is not None:
+        data = data[list(columns)]
+    return data
+
+
+def _range_validator(headers: Mapping[str, str]) -> Optional[str]:
+    """Return the validator to make range requests conditional on."""
+    # Weak ETags can not be used for range requests
+    etag = headers.get('ETag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
 
 class SleepCycle:
     def __init__(self) -> None:
         self.zip_data_path = ZIP_FILE
         self.json_data_path = JSON_FILE
 
-    @property
+    @cached_property
     def session(self) -> requests.Session:
         """Requests Session authenticated against SleepSecure."""
-        if hasattr(self, '_session'):
-            return self._session
-
         conf = config['sleepcycle']
-        email = conf['email']
-        password = conf['password']
-        self.headers = {'username': email, 'password': password}
+        session = requests.Session()
 
-        self._session: requests.Session = requests.Session()
-        self._session.get(SLEEP_CYCLE_LOGIN_URL)
-        self._session.post(
-            SLEEP_CYCLE_LOGIN_URL,
-            data=self.headers,
+        # Keep one alive connection per concurrent download worker, all
+        # requests go to the same host. Requests which are rate limited or hit
+        # server errors are retried, instead of aborting a long cache update.
+        retries = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=DOWNLOAD_WORKERS,
+            max_retries=retries,
         )
+        session.mount('https://', adapter)
 
-        self.headers['Cookies'] = "; ".join(
-            [
-                str(key) + "=" + str(value)
-                for key, value
-                in self._session.cookies.items()
-            ],
+        session.get(SLEEP_CYCLE_LOGIN_URL)
+        session.post(
+            SLEEP_CYCLE_LOGIN_URL,
+            data={'username': conf['email'], 'password': conf['password']},
         )
 
-        return self._session
+        return session
 
-    @property
+    @cached_property
     def last_sleepsession_id(self) -> int:
         """Return the session ID of the latest recorded sleep data."""
-        if not hasattr(self, '_last_sleepsession_id'):
-            self.persist_first_and_last_sleepsession_id()
-        return self._last_sleepsession_id
+        return self.sleepsession_ids[1]
 
-    @property
+    @cached_property
     def first_sleepsession_id(self) -> int:
         """Return the session ID of the latest recorded sleep data."""
-        if not hasattr(self, '_first_sleepsession_id'):
-            self.persist_first_and_last_sleepsession_id()
-        return self._first_sleepsession_id
+        return self.sleepsession_ids[0]
 
-    def persist_first_and_last_sleepsession_id(self) -> None:
-        """Fetch and persist the first and last sleepsession IDs."""
-        landing_page = self.session.get(BASE_URL + '/site/comp/totalstat').text
+    @cached_property
+    def sleepsession_ids(self) -> Tuple[int, int]:
+        """Fetch the first and last sleepsession IDs."""
+        landing_page = self.session.get(BASE_URL + '/site/comp/totalstat')
+
+        # Both IDs are found in a single pass over the undecoded page
+        ids = dict(SLEEPSESSION_ID_PATTERN.findall(landing_page.content))
 
         # No, this is not a bug. `first_sleepsession_id` is indeed the *newest*
         # data point, and `last_sleepsession_id` is the *first* recorded data
         # type.
-        self._first_sleepsession_id: int = int(re.search(
-            r'var last_sleepsession_id = \'(\d+)\'',
-            landing_page,
-        ).group(1))
-        self._last_sleepsession_id: int = int(re.search(
-            r'var first_sleepsession_id = \'(\d+)\'',
-            landing_page,
-        ).group(1))
+        return int(ids[b'last']), int(ids[b'first'])
 
     def download_data(self) -> None:
-        """Download the latest SleepCycle data to the data directory."""
-        response = self.session.get(SLEEP_CYCLE_DATA_URL, stream=True)
-        assert response.status_code == 200
+        """
+        Download the latest SleepCycle data to the data directory.
+
+        The data is downloaded to a partial file which is moved into place
+        when complete. An interrupted download is resumed from the partial
+        file, if the server supports HTTP range requests.
+        """
+        part_path = self.zip_data_path.with_name(
+            self.zip_data_path.name + '.part',
+        )
+        validator_path = part_path.with_name(part_path.name + '.validator')
+        if part_path.is_file():
+            self.download_data_sequentially(
+                part_path=part_path,
+                validator_path=validator_path,
+            )
+        else:
+            head = self.session.head(SLEEP_CYCLE_DATA_URL, allow_redirects=True)
+            size = int(head.headers.get('Content-Length', 0))
+            validator = _range_validator(head.headers)
+            if (
+                head.headers.get('Accept-Ranges') == 'bytes'
+                and size > DOWNLOAD_CHUNK_SIZE
+                and validator
+                and hasattr(os, 'pwrite')
+            ):
+                self.download_data_in_parallel(
+                    part_path=part_path,
+                    validator_path=validator_path,
+                    url=head.url,
+                    size=size,
+                    validator=validator,
+                )
+            else:
+                self.download_data_sequentially(
+                    part_path=part_path,
+                    validator_path=validator_path,
+                )
+
+        validator_path.unlink(missing_ok=True)
+        if not is_zipfile(part_path):
+            part_path.unlink()
+            raise ValueError('Downloaded SleepCycle data is not a zip file')
+        os.replace(part_path, self.zip_data_path)
+
+    def download_data_sequentially(
+        self,
+        part_path: Path,
+        validator_path: Path,
+    ) -> None:
+        """
+        Download SleepCycle data as a single streamed HTTP request.
+
+        Any bytes already present in `part_path` are skipped by requesting the
+        remaining range only. The range is conditional on the export being
+        unchanged since the partial download started, as identified by the
+        ETag or Last-Modified validator stored in `validator_path`. The
+        download restarts from the beginning otherwise, or if the server does
+        not honour the range.
+        """
+        headers = {}
+        if part_path.is_file() and validator_path.is_file():
+            # Byte offsets refer to the encoded content, so the resumed range
+            # must be transferred without any content encoding.
+            headers = {
+                'Range': f'bytes={part_path.stat().st_size}-',
+                'If-Range': validator_path.read_text(),
+                'Accept-Encoding': 'identity',
+            }
+
+        response = self.session.get(
+            SLEEP_CYCLE_DATA_URL,
+            headers=headers,
+            stream=True,
+        )
+        if response.status_code == 416:
+            # The partial file does not match the current export
+            response.close()
+            response = self.session.get(SLEEP_CYCLE_DATA_URL, stream=True)
+
+        # The response is closed when done, releasing the connection back to
+        # the session's pool even if the copy fails halfway.
+        with response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                validator = _range_validator(response.headers)
+                if validator:
+                    validator_path.write_text(validator)
+                else:
+                    validator_path.unlink(missing_ok=True)
+
+            # Copy straight from the underlying urllib3 stream, decompressing
+            # any transfer encoding, without the iter_content generator in
+            # between. Chunks larger than the file buffer are written
+            # through to disk directly.
+            response.raw.decode_content = True
+            with open(part_path, mode) as handle:
+                shutil.copyfileobj(
+                    response.raw,
+                    handle,
+                    length=DOWNLOAD_CHUNK_SIZE,
+                )
+
+    def download_data_in_parallel(
+        self,
+        part_path: Path,
+        validator_path: Path,
+        url: str,
+        size: int,
+        validator: str,
+    ) -> None:
+        """
+        Download SleepCycle data as concurrent HTTP range requests.
 
-        with open(self.zip_data_path, "wb") as handle:
-            for chunk in response.iter_content(chunk_size=512):
-                if chunk:  # filter out keep-alive new chunks
-                    handle.write(chunk)
+        The file is preallocated to `size` bytes, and each range is written
+        directly to its offset as soon as it has been received. Every range is
+        conditional on `validator`, so that ranges from different versions of
+        the export are never mixed. If the export has changed since, the data
+        is downloaded sequentially instead. The preallocated file can not be
+        resumed from, so it is removed if the download fails.
+        """
+        byte_ranges = [
+            (start, min(start + DOWNLOAD_CHUNK_SIZE, size) - 1)
+            for start
+            in range(0, size, DOWNLOAD_CHUNK_SIZE)
+        ]
+
+        with open(part_path, 'wb') as handle:
+            handle.truncate(size)
+            file_descriptor = handle.fileno()
+
+            def download_range(byte_range: Tuple[int, int]) -> bool:
+                start, end = byte_range
+                # Byte offsets refer to the encoded content, so the ranges
+                # must be transferred without any content encoding.
+                headers = {
+                    'Range': f'bytes={start}-{end}',
+                    'If-Range': validator,
+                    'Accept-Encoding': 'identity',
+                }
+                with self.session.get(url, headers=headers, stream=True) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        # The whole, changed export is left unread
+                        return False
+                    os.pwrite(file_descriptor, response.content, start)
+                    return True
+
+            executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+            try:
+                # Consume the results in order to propagate any exceptions,
+                # stopping at the first range which was not honoured.
+                honoured = all(executor.map(download_range, byte_ranges))
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                part_path.unlink()
+                raise
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if not honoured:
+            part_path.unlink()
+            self.download_data_sequentially(
+                part_path=part_path,
+                validator_path=validator_path,
+            )
 
     def unzip_data(self) -> None:
-        """Unzip exported data."""
+        """
+        Unzip exported JSON data.
+
+        Extraction is skipped if the JSON file has already been extracted from
+        the current zip file.
+        """
         if not ZIP_FILE.is_file():
             self.download_data()
 
         with ZipFile(ZIP_FILE, 'r') as zip_file:
-            zip_file.extractall(DATA_DIRECTORY)
+            info = zip_file.getinfo(JSON_FILE.name)
+            if (
+                JSON_FILE.is_file()
+                and JSON_FILE.stat().st_size == info.file_size
+                and JSON_FILE.stat().st_mtime >= ZIP_FILE.stat().st_mtime
+            ):
+                return
 
-    def load_json(self) -> pd.DataFrame:
-        """Load exported JSON file into pandas DataFrame."""
-        if not JSON_FILE.is_file():
-            self.unzip_data()
+            with zip_file.open(info) as source, open(JSON_FILE, 'wb') as target:
+                shutil.copyfileobj(source, target)
 
-        return pd.read_json(
-            path_or_buf=JSON_FILE,
-            orient='records',
-            convert_dates=['start', 'stop'],
-        )
+    def load_json(
+        self,
+        columns: Optional[Iterable[str]] = None,
+    ) -> 'pd.DataFrame':
+        """
+        Load exported JSON file into pandas DataFrame.
 
-    @property
-    def data(self) -> pd.DataFrame:
-        """Return data from 'export' functionality of SleepSecure(TM)."""
-        if not hasattr(self, '_data'):
-            self._data = self.load_json()
+        The parsed data is cached as a Parquet file, which is used instead of
+        the exported data for as long as the export is left unchanged.
+
+        :param columns: Only load these columns, e.g. ['start', 'stop']. All
+            columns are loaded if not specified.
+        """
+        # The JSON data is read straight out of the zip file, without
+        # extracting it to disk first. A previously extracted JSON file is
+        # only used if the zip file is no longer around.
+        if ZIP_FILE.is_file() or not JSON_FILE.is_file():
+            if not ZIP_FILE.is_file():
+                self.download_data()
+            source = ZIP_FILE
+        else:
+            source = JSON_FILE
+
+        # Copies of Arrow backed columns share the immutable Arrow buffers,
+        # so this only protects the shared data frame from modifications.
+        return _load_export(
+            source,
+            source.stat().st_mtime_ns,
+            tuple(columns) if columns is not None else None,
+        ).copy()
 
-        return self._data
+    @cached_property
+    def data(self) -> 'pd.DataFrame':
+        """Return data from 'export' functionality of SleepSecure(TM)."""
+        return self.load_json()
 
-    def fetch(self, endpoint: str, params: Dict = {}) -> Dict:
+    def fetch(self, endpoint: str, params: Optional[Dict] = None) -> Dict:
         """Fetch JSON from SleepSecure(TM) endpoint."""
-        return self.session.get(BASE_URL + endpoint, params=params).json()
+        response = self.session.get(BASE_URL + endpoint, params=params)
+        return orjson.loads(response.content)
 
     def __len__(self) -> int:
         """Return the number of sleep sessions recorded."""
         return self.data.shape[0]
 
+    @cached_property
+    def sleep_sessions_cache(self) -> 'SleepSessionsCache':
+        """Return sleep sessions cached to disk."""
+        return SleepSessionsCache()
+
+    @cached_property
+    def sleep_session_manager(self) -> 'SleepSessions':
+        """Return manager of sleep sessions fetched from SleepSecure(TM)."""
+        return SleepSessions(
+            first_sleepsession_id=self.first_sleepsession_id,
+            last_sleepsession_id=self.last_sleepsession_id,
+            session=self.session,
+            cache=self.sleep_sessions_cache,
+        )
+
     def update_sleep_sessions_cache(self) -> None:
-        if not hasattr(self, 'sleep_sessions'):
-            self.sleep_session_manager = SleepSessions(
-                first_sleepsession_id=self.first_sleepsession_id,
-                last_sleepsession_id=self.last_sleepsession_id,
-                session=self.session,
-            )
-        days_since_last_export = (pd.Timestamp.today() - self.data.iloc[0]['stop']).days
+        import pandas as pd
+
+        last_stop = self.data['stop'].iat[0]
+        days_since_last_export = (pd.Timestamp.today() - last_stop).days
         self.sleep_session_manager.update_cache(
             total_items=len(self) + days_since_last_export,
         )
 
     @property
-    def sleep_sessions(self) -> pd.DataFrame:
-        if not hasattr(self, '_sleep_sessions'):
-            with open(self.sleep_session_manager.cache.path) as cache:
-                self._sleep_sessions = pd.DataFrame(
-                    list(json.load(cache)['sleep_sessions'].values()),
-                )
+    def sleep_sessions(self) -> 'pd.DataFrame':
+        """
+        Return cached sleep sessions as a data frame.
 
-        return self._sleep_sessions
+        Only the sessions already cached to disk are returned, without
+        authenticating against SleepSecure(TM), unless the cache has been
+        updated with `update_sleep_sessions_cache`.
+        """
+        return self.sleep_sessions_cache.to_dataframe()
 
 
 class SleepSessionJSON(TypedDict):
@@ -183,66 +508,156 @@ class SleepSessionJSON(TypedDict):
     xaxis: List[Tuple[float, str]]      # [70.626328038045131, "05"]
     graph_tib: str                      # "8:14"
     start_tick: float                   # 471823918.51976001
-    stats_wakeup: int                   # 0 or 1
+    stats_wakeups: int                  # 0
     stats_duration: float               # 29648.53155601025
     stats_sol: int                      # 0 or 1
     stats_mph: float                    # 2.8861129111405419
     window_stop: str                    # "2015-12-15T07:25:00"
     state_mode: int                     # 2
-    graph_indbed: str                   # "23:11 - 07:26"
+    graph_inbed: str                    # "23:11 - 07:26"
     steps: str                          # "4261 steps"
     start_local: str                    # "2015-12-14T23:11:58"
 
 
+# Compact, nullable pandas data types for the numeric SleepSessionJSON fields
+SLEEP_SESSION_DTYPES = {
+    'id': 'Int64',
+    'rating': 'Int8',
+    'alarm_mode': 'Int8',
+    'state_mode': 'Int8',
+    'stats_version': 'Int8',
+    'stats_wakeups': 'Int8',
+    'stats_sol': 'Int8',
+    'seconds_from_gmt': 'Int32',
+    'start_tick': 'Float64',
+    'stop_tick': 'Float64',
+    'stats_duration': 'Float64',
+    'stats_sq': 'Float64',
+    'stats_mph': 'Float64',
+}
+
+# SleepSessionJSON fields except for the large per-minute graph data
+SLEEP_SESSION_FIELDS = frozenset(SleepSessionJSON.__annotations__) - {
+    'graph',
+    'xaxis',
+}
+
+
 class SleepSessionsJSONCache(TypedDict):
     sleep_sessions: Dict[int, SleepSessionJSON]
     newest_session_id: int
     first_session_id: int
 
 
+# Caches with possibly unflushed insertions. Only weak references are kept,
+# such that caches can still be garbage collected before the interpreter exits.
+_open_caches: 'weakref.WeakSet[SleepSessionsCache]' = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_caches() -> None:
+    """Persist pending insertions of all caches still alive at exit."""
+    for cache in list(_open_caches):
+        cache.flush()
+
+
 class SleepSessionsCache:
-    """SleepSession JSON objects persisted to disk."""
+    """
+    SleepSession JSON objects persisted to disk.
+
+    Sleep sessions are stored in JSON Lines format, one `{id: session}` object
+    per line, such that each insertion only has to append a single line to
+    the cache file. The IDs of the newest and first inserted sessions are
+    stored in a small sidecar file next to the cache file.
+
+    Insertions are buffered in memory and written to disk by `flush()`, which
+    is invoked for every FLUSH_SIZE insertions, when leaving a `with` block
+    around the cache, when the cache is garbage collected, and at the latest
+    when the interpreter exits.
+
+    Re-inserting a cached session appends a new line which supersedes the
+    earlier one. Once superseded lines outnumber the cached sessions, the
+    cache file is rewritten by `compact()`.
+    """
     memory: SleepSessionsJSONCache
-    DEFAULT_PATH = DATA_DIRECTORY / 'sleep_sessions.json'
+    DEFAULT_PATH = DATA_DIRECTORY / 'sleep_sessions.jsonl'
+    FLUSH_SIZE = 128
+
+    def __init__(
+        self,
+        json_file: Path = DEFAULT_PATH,
+        fields: Optional[AbstractSet[str]] = None,
+    ) -> None:
+        """
+        Initialize a cache persisted to `json_file`.
 
-    def __init__(self, json_file: Path = DEFAULT_PATH) -> None:
-        """Initialize a cache persisted to `json_file`."""
+        :param json_file: Path to JSON Lines file used for persistence.
+        :param fields: Only store these sleep session fields, for instance
+            SLEEP_SESSION_FIELDS. The 'id' field is always stored. All fields
+            are stored if not specified.
+        """
+        self.pending: Dict[int, SleepSessionJSON] = {}
         self.path = json_file
+        self.fields = fields and {'id', *fields}
+        self.meta_path = json_file.with_suffix('.meta.json')
+        self.superseded = 0
+        self.dataframe: Optional['pd.DataFrame'] = None
+        _open_caches.add(self)
+        self.memory = {
+            'sleep_sessions': {},
+            'newest_session_id': 0,
+            'first_session_id': 0,
+        }
+
+        legacy_path = self.path.with_suffix('.json')
+        if not self.path.is_file() and legacy_path.is_file():
+            self.migrate(legacy_path)
+            return
 
         if not self.path.is_file():
-            # No sleep sessions have been cached, so we need to create an empty
-            # cache file
-            self.memory = {
-                'sleep_sessions': {},
-                'newest_session_id': 0,
-                'first_session_id': 0,
-            }
-            with open(self.path, 'w') as cache_file:
-                json.dump(self.memory, cache_file)
-        else:
-            # There are existing cached sleep sessions. We need to import them
-            # into memory, and cast string indeces to integer values, as JSON
-            # does not support integer indexes in dictionaries.
-            with open(self.path, 'r') as cache_file:
-                content = json.load(cache_file)
-                sleep_sessions = {
-                    int(session_id): sleep_session
-                    for session_id, sleep_session
-                    in content['sleep_sessions'].items()
-                }
+            # No sleep sessions have been cached, so we need to create empty
+            # cache files
+            self.path.touch()
+            self.save_meta()
+            return
 
-                if content['newest_session_id']:
-                    self.memory = {
-                        'newest_session_id': int(content['newest_session_id']),
-                        'first_session_id': int(content['first_session_id']),
-                        'sleep_sessions': sleep_sessions,
-                    }
-                else:
-                    self.memory = {
-                        'newest_session_id': 0,
-                        'first_session_id': 0,
-                        'sleep_sessions': sleep_sessions,
-                    }
+        # There are existing cached sleep sessions. We need to import them
+        # into memory, and cast string indeces to integer values, as JSON
+        # does not support integer indexes in dictionaries.
+        sleep_sessions = self.memory['sleep_sessions']
+        lines = 0
+        with open(self.path, 'rb') as cache_file:
+            for line in cache_file:
+                for session_id, sleep_session in orjson.loads(line).items():
+                    sleep_sessions[int(session_id)] = sleep_session
+                lines += 1
+        self.superseded = lines - len(sleep_sessions)
+
+        if self.meta_path.is_file():
+            meta = orjson.loads(self.meta_path.read_bytes())
+            self.memory['newest_session_id'] = int(meta['newest_session_id'])
+            self.memory['first_session_id'] = int(meta['first_session_id'])
+
+    def migrate(self, legacy_path: Path) -> None:
+        """
+        Import sleep sessions cached by earlier versions of this class.
+
+        Sessions used to be cached as a single JSON object, with the sessions
+        and the newest/first session IDs in the same file. The legacy file is
+        left untouched, and can be deleted once migrated.
+        """
+        content = orjson.loads(legacy_path.read_bytes())
+        self.memory = {
+            'sleep_sessions': {
+                int(session_id): sleep_session
+                for session_id, sleep_session
+                in content['sleep_sessions'].items()
+            },
+            'newest_session_id': int(content['newest_session_id'] or 0),
+            'first_session_id': int(content['first_session_id'] or 0),
+        }
+        self.path.write_bytes(self.dump_lines(self.memory['sleep_sessions']))
+        self.save_meta()
 
     def __setitem__(
         self,
@@ -251,14 +666,157 @@ class SleepSessionsCache:
     ) -> None:
         """Insert a new sleep session into the cache."""
         assert session_id != 0
+        if self.fields:
+            sleep_session = {  # type: ignore
+                key: value
+                for key, value
+                in sleep_session.items()
+                if key in self.fields
+            }
+        if (
+            session_id in self.memory['sleep_sessions']
+            and session_id not in self.pending
+        ):
+            self.superseded += 1
         self.memory['sleep_sessions'][session_id] = sleep_session
+        self.pending[session_id] = sleep_session
+        self.dataframe = None
 
         self.memory['newest_session_id'] = session_id
         if not self.memory['first_session_id']:
             self.memory['first_session_id'] = session_id
 
-        with open(self.path, 'w') as cache_file:
-            json.dump(self.memory, cache_file)
+        if len(self.pending) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Persist sleep sessions inserted since the last flush to disk."""
+        if not self.pending:
+            return
+
+        if self.superseded > len(self.memory['sleep_sessions']):
+            self.compact()
+            return
+
+        with open(self.path, 'ab') as cache_file:
+            cache_file.write(self.dump_lines(self.pending))
+        self.pending.clear()
+        self.save_meta()
+
+    def compact(self) -> None:
+        """
+        Rewrite the cache file with only the current version of each session.
+
+        The new cache file is written next to the old one and then moved into
+        place, such that an interrupted rewrite never loses cached sessions.
+        """
+        compacted_path = self.path.with_suffix('.compacting')
+        compacted_path.write_bytes(
+            self.dump_lines(self.memory['sleep_sessions']),
+        )
+        os.replace(compacted_path, self.path)
+        self.pending.clear()
+        self.superseded = 0
+        self.save_meta()
+
+    @staticmethod
+    def dump_lines(sleep_sessions: Dict[int, SleepSessionJSON]) -> bytes:
+        """Return sleep sessions serialized as JSON Lines."""
+        return b''.join(
+            orjson.dumps(
+                {session_id: sleep_session},
+                option=orjson.OPT_NON_STR_KEYS,
+            ) + b'\n'
+            for session_id, sleep_session
+            in sleep_sessions.items()
+        )
+
+    def __enter__(self) -> 'SleepSessionsCache':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def __del__(self) -> None:
+        self.flush()
+
+    def save_meta(self) -> None:
+        """Persist IDs of the newest and first inserted sleep sessions."""
+        self.meta_path.write_bytes(orjson.dumps({
+            'newest_session_id': self.memory['newest_session_id'],
+            'first_session_id': self.memory['first_session_id'],
+        }))
+
+    def to_dataframe(self, chunksize: int = 10_000) -> 'pd.DataFrame':
+        """
+        Return cached sleep sessions as a data frame.
+
+        The data frame is constructed once and reused until new sessions are
+        inserted into the cache.
+
+        :param chunksize: Number of sessions converted at a time. Only the
+            intermediate Python lists of a single chunk are held in memory
+            while the typed columns are constructed.
+        """
+        if self.dataframe is not None:
+            return self.dataframe
+
+        import pandas as pd
+
+        sessions = list(self.memory['sleep_sessions'].values())
+
+        # Build each column directly with the data type known from the
+        # SleepSessionJSON schema, instead of letting pandas infer types row by
+        # row. Any fields not present in the schema are inferred as usual.
+        fields = dict.fromkeys(
+            field
+            for session in sessions
+            for field in session
+        )
+        chunks = [
+            pd.DataFrame(
+                {
+                    field: pd.Series(
+                        [session.get(field) for session in chunk],
+                        dtype=SLEEP_SESSION_DTYPES.get(field),
+                    )
+                    for field in fields
+                },
+                copy=False,
+            )
+            for chunk in (
+                sessions[start:start + chunksize]
+                for start in range(0, len(sessions), chunksize)
+            )
+        ]
+        if len(chunks) == 1:
+            dataframe = chunks[0]
+        else:
+            dataframe = pd.concat(
+                chunks or [pd.DataFrame(columns=list(fields))],
+                ignore_index=True,
+            )
+        del chunks
+
+        # The datetime columns share many of their values, e.g. the window
+        # offsets and the local start/stop times, so we parse each unique
+        # string only once and map the result back onto the columns. Values
+        # which are not ISO 8601 timestamps become NaT.
+        columns = [
+            column
+            for column in SLEEP_SESSION_DATETIME_FIELDS
+            if column in dataframe
+        ]
+        strings = pd.unique(dataframe[columns].to_numpy().ravel())
+        timestamps = pd.Series(
+            pd.to_datetime(strings, format='ISO8601', errors='coerce'),
+            index=strings,
+        )
+        for column in columns:
+            dataframe[column] = dataframe[column].map(timestamps)
+
+        self.dataframe = dataframe
+        return dataframe
 
     def insert(self, session: SleepSessionJSON) -> None:
         """Insert sleep session json into the cache."""
@@ -297,36 +855,185 @@ class SleepSessionsCache:
 
 
 class SleepSessions:
+    """
+    Sleep sessions fetched from the SleepSecure(TM) API.
+
+    Sleep session IDs are opaque datastore keys, e.g. 5029422020165632, which
+    are neither contiguous nor evenly spaced, and no endpoint lists them. The
+    ID of a session can therefore only be found by requesting the neighbouring
+    session with the `next`/`prev` flags. See `update_cache` for how this
+    chain is walked.
+    """
+
     def __init__(
         self,
         first_sleepsession_id: int,
         last_sleepsession_id: int,
         session: requests.Session,
+        fields: Optional[AbstractSet[str]] = None,
+        cache: Optional[SleepSessionsCache] = None,
     ) -> None:
         self.first_sleepsession_id = first_sleepsession_id
         self.last_sleepsession_id = last_sleepsession_id
         self.session = session
-        self.cache = SleepSessionsCache()
+        if cache is None:
+            cache = SleepSessionsCache(fields=fields)
+        self.cache = cache
 
     def update_cache(self, total_items: Optional[int] = None) -> None:
         """Fetch new data from SleepSecure(TM) API."""
+        import progressbar
+
         bar = progressbar.ProgressBar(
             inital_value=0,
             max_value=total_items or progressbar.UnknownLength,
         )
-        if not self.cache.newest:
-            self.cache.insert(self.sleep_session(
-                session_id=self.first_sleepsession_id,
-                next_=False,
-            ))
-            bar.update(1)
-
-        while self.last_sleepsession_id not in self.cache:
-            self.cache.insert(self.sleep_session(  # type: ignore
-                session_id=self.cache.newest['id'],  # type: ignore
-                next_=True,
-            ))
-            bar.update(len(self.cache))
+        with self.cache, ThreadPoolExecutor(max_workers=1) as executor:
+            if not self.cache.newest:
+                self.cache.insert(self.sleep_session(
+                    session_id=self.first_sleepsession_id,
+                    next_=False,
+                ))
+                bar.update(1)
+
+            if self.last_sleepsession_id in self.cache:
+                return
+
+            # The remaining chain of sessions is walked from both ends at once.
+            # Sessions fetched backwards from the last session are kept aside
+            # until the two walks meet, such that the cache always contains an
+            # unbroken chain starting at the first session.
+            stop = threading.Event()
+            backward_ids: Set[int] = set()
+            backward = executor.submit(
+                self.walk_backward,
+                fetched_ids=backward_ids,
+                stop=stop,
+            )
+            try:
+                for sleep_session in self.prefetch(
+                    session_id=self.cache.newest['id'],  # type: ignore
+                    stop_ids=backward_ids,
+                ):
+                    if int(sleep_session['id']) in backward_ids:
+                        break
+                    self.cache.insert(sleep_session)
+                    bar.update(len(self.cache))
+            finally:
+                stop.set()
+
+            try:
+                backward_sessions = backward.result()
+            except Exception:
+                # The sessions fetched backwards are lost, but the cache is
+                # still an unbroken chain from the first session. If the
+                # forward walk stopped where the backward walk began, it is
+                # continued up to the last session on its own.
+                logger.warning(
+                    'Walking sleep sessions backwards failed',
+                    exc_info=True,
+                )
+                backward_sessions = []
+                for sleep_session in self.prefetch(
+                    session_id=self.cache.newest['id'],  # type: ignore
+                ):
+                    self.cache.insert(sleep_session)
+                    bar.update(len(self.cache))
+
+            for sleep_session in reversed(backward_sessions):
+                if int(sleep_session['id']) not in self.cache:
+                    self.cache.insert(sleep_session)
+                    bar.update(len(self.cache))
+
+    def walk_backward(
+        self,
+        fetched_ids: Set[int],
+        stop: threading.Event,
+    ) -> List[SleepSessionJSON]:
+        """
+        Fetch sleep sessions from the last session towards the cached ones.
+
+        :param fetched_ids: Set which is populated with the IDs of the fetched
+            sessions while walking.
+        :param stop: Event which stops the walk when set.
+        :return: Sleep sessions not yet cached, starting with the last one.
+        """
+        sleep_sessions: List[SleepSessionJSON] = []
+        sleep_session = self.request_sleep_session(
+            session_id=self.last_sleepsession_id,
+        )
+        while not stop.is_set() and int(sleep_session['id']) not in self.cache:
+            sleep_sessions.append(sleep_session)
+            fetched_ids.add(int(sleep_session['id']))
+            sleep_session = self.request_sleep_session(
+                session_id=sleep_session['id'],
+                previous=True,
+            )
+
+        return sleep_sessions
+
+    def prefetch(
+        self,
+        session_id: int,
+        stop_ids: AbstractSet[int] = frozenset(),
+    ) -> Iterator[SleepSessionJSON]:
+        """
+        Yield sleep sessions following `session_id`, up to the last session.
+
+        Each session ID is only known from the response of the preceding
+        session, so the sessions can not be requested concurrently. Instead,
+        a background thread walks the chain of sessions and stays up to
+        PREFETCH_SIZE sessions ahead of the consumer, such that the HTTP round
+        trips overlap with processing of already fetched sessions.
+
+        :param session_id: ID of the session preceding the yielded sessions.
+        :param stop_ids: IDs of sessions which are already known, e.g. from
+            walking the chain backwards. The walk ends after yielding the
+            first of these, instead of fetching up to PREFETCH_SIZE sessions
+            that the consumer will discard.
+        """
+        sleep_sessions: queue.Queue = queue.Queue(maxsize=PREFETCH_SIZE)
+        stop = threading.Event()
+
+        def put(item: Any) -> None:
+            while not stop.is_set():
+                try:
+                    sleep_sessions.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def walk() -> None:
+            next_id = session_id
+            try:
+                while (
+                    next_id != self.last_sleepsession_id
+                    and next_id not in stop_ids
+                    and not stop.is_set()
+                ):
+                    sleep_session = self.request_sleep_session(
+                        session_id=next_id,
+                        next_=True,
+                    )
+                    put(sleep_session)
+                    next_id = int(sleep_session['id'])
+            except Exception as exception:
+                put(exception)
+            put(None)
+
+        walker = threading.Thread(target=walk, daemon=True)
+        walker.start()
+        try:
+            while True:
+                item = sleep_sessions.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            walker.join()
 
     def __len__(self) -> int:
         """Return the number of fetched sleep session data."""
@@ -344,25 +1051,36 @@ class SleepSessions:
         `next_` and `previous` flags indicate getting the next/previous
         available sleep session.
         """
+        if not (next_ or previous) and session_id in self.cache:
+            return self.cache[session_id]
+
+        session_response = self.request_sleep_session(
+            session_id=session_id,
+            next_=next_,
+            previous=previous,
+        )
+        if session_response['id'] not in self.cache:
+            self.cache[session_response['id']] = session_response
+
+        return session_response
+
+    def request_sleep_session(
+        self,
+        session_id: int,
+        next_: bool = False,
+        previous: bool = False,
+    ) -> SleepSessionJSON:
+        """Request SleepSessionJSON from SleepSecure(TM), bypassing the cache."""
         params = {'id': str(session_id)}
         if next_:
             params['next'] = '1'
         elif previous:
             params['prev'] = '1'
-        elif session_id in self.cache:
-            return self.cache[session_id]
 
+        response = self.session.get(BASE_URL + '/stat/session', params=params)
         try:
-            session_response = self.session.get(
-                BASE_URL + '/stat/session',
-                params=params,
-            ).json()
-
-            if session_response['id'] not in self.cache:
-                self.cache[session_response['id']] = session_response
-
-            return session_response
-        except json.decoder.JSONDecodeError:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
             if next_:
                 raise ValueError('No next sleepsession')
             elif previous:
@@ -1,23 +1,26 @@
 import datetime
-import json
+import math
 import time
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple, cast
 
 from mypy_extensions import TypedDict
 
-import numpy as np
-
-import progressbar
+import orjson
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 from .config import DATA_DIRECTORY, config
 
 
 TOGGL_BASE_URL = 'https://toggl.com/reports/api/v2'
 
+# Minimum number of seconds between requests, as per Toggl's rate limit
+TOGGL_REQUEST_INTERVAL = 1.0
+
 
 class DetailDict(TypedDict):
     """JSON dictionary for a single time entry."""
@@ -46,6 +49,10 @@ class DetailsDict(TypedDict):
     data: List[DetailDict]
 
 
+# Paginated details of a single year, keyed by page number
+YearDetails = Dict[str, DetailsDict]
+
+
 class Toggl:
     """Class for retrieving and processing Toggl data."""
 
@@ -53,19 +60,34 @@ class Toggl:
         """Construct Toggl object. """
         conf = config['toggl']
 
-        self.auth = HTTPBasicAuth(
+        # A single session reuses the same connection for all requests, and
+        # retries requests which are rate limited or hit server errors.
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(
             conf['api_token'],
             'api_token',
         )
+        retries = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+
         self.headers = {
             'user_agent': conf['email'],
             'workspace_id': conf['workspace_id'],
         }
-        self.details_path = DATA_DIRECTORY / 'toggl' / 'details.json'
-        self.details_path.parent.mkdir(parents=True, exist_ok=True)
+        self.base_params = list(self.headers.items())
+        self.details_path = DATA_DIRECTORY / 'toggl' / 'details'
+        self.details_path.mkdir(parents=True, exist_ok=True)
+        legacy_path = self.details_path.with_suffix('.json')
+        if legacy_path.is_file() and not any(self.details_path.glob('*.json')):
+            self.migrate(legacy_path)
         self.tidy_details_path = DATA_DIRECTORY / 'toggl' / 'tidy_details.json'
+        self.last_request_time = -TOGGL_REQUEST_INTERVAL
 
-    def fetch(self, path: str, params: Dict[str, str] = {}) -> Dict:
+    def fetch(self, path: str, params: Optional[Dict[str, Any]] = None) -> Dict:
         """
         Fetch data from Toggl JSON API.
 
@@ -73,22 +95,40 @@ class Toggl:
         :param params: Additional URL parameters to include in query.
         :return: JSON response in form of a python dictionary.
         """
-        response = requests.get(
+        # Stay under the Toggl rate limit. The interval is counted from the
+        # start of the previous request, such that time spent waiting for and
+        # processing responses counts towards it.
+        wait = (
+            self.last_request_time
+            + TOGGL_REQUEST_INTERVAL
+            - time.monotonic()
+        )
+        if wait > 0:
+            time.sleep(wait)
+        self.last_request_time = time.monotonic()
+
+        if params:
+            merged_params = self.base_params + list(params.items())
+        else:
+            merged_params = self.base_params
+
+        response = self.session.get(
             url=TOGGL_BASE_URL + path,
-            auth=self.auth,
-            params={**self.headers, **params},
+            params=merged_params,
         )
-        return response.json()
+        return orjson.loads(response.content)
 
-    def fetch_details(self) -> Dict:
+    def fetch_details(self) -> None:
         """
         Fetch and store all new detailed time entries.
 
         The result is available from self.details after invoked.
         """
+        import progressbar
+
         # We store the results keyed to year, then page of paginated results.
         # We prepopulate the results with earlier cached results.
-        result: Dict[int, Dict[int, DetailsDict]] = self.details
+        result: Dict[str, YearDetails] = self.details
 
         # We only start fetching for the newest year that we have previously
         # fetched.
@@ -101,43 +141,37 @@ class Toggl:
 
         years = progressbar.progressbar(range(earliest_year, current_year + 1))
         for year in years:
-            # Sleep for one second in order to stay under Toggl rate limit
-            time.sleep(1)
-
             # Fetch detailed time entries for entire year
             params = {'since': f'{year}-01-01', 'until': f'{year + 1}-01-01'}
-            details: DetailsDict = self.fetch('/details', params=params)
+            details = cast(DetailsDict, self.fetch('/details', params=params))
 
             # Create the dictionary that will store all the pages for this year
             result.setdefault(str(year), {})
             result[str(year)]['1'] = details
 
-            # Skip this year if cache total is equal to year total
+            # Only fetch the remaining pages if cache total is different from
+            # the year total
             saved_count = sum(
                 len(page.get('data', []))
                 for page
                 in result[str(year)].values()
             )
-            if saved_count == details['total_count']:
-                continue
-
-            # Calculate how many pages there are in this year
-            pages = int(np.ceil(details['total_count'] / details['per_page']))
-
-            # Fetch the remaining pages
-            for page in range(2, pages + 1):
-                # Stay under the rate limit
-                time.sleep(1)
-
-                # Fetch and store the given page
-                details = self.fetch(
-                    '/details',
-                    params={**params, 'page': page},
-                )
-                result[str(year)][str(page)] = details
-
-        # Save the result, automatically saving to disk with the setter property
-        self.details = result
+            if saved_count != details['total_count']:
+                # Calculate how many pages there are in this year
+                pages = math.ceil(details['total_count'] / details['per_page'])
+
+                # Fetch the remaining pages
+                for page in range(2, pages + 1):
+                    # Fetch and store the given page
+                    details = cast(DetailsDict, self.fetch(
+                        '/details',
+                        params={**params, 'page': page},
+                    ))
+                    result[str(year)][str(page)] = details
+
+            # Save the result for this year only, as earlier years are
+            # unchanged
+            self.save_year(year=year, pages=result[str(year)])
 
     def save_tidy_details(self) -> Path:
         """
@@ -149,25 +183,55 @@ class Toggl:
 
         :return: Path to json file with tidy data content.
         """
-        details = self.details
-        tidy_data = []
-        for year in details.values():
-            for page in year.values():
-                for time_entry in page['data']:
-                    tidy_data.append(time_entry)
-
-        self.tidy_details_path.write_text(json.dumps(tidy_data))
+        # The JSON array is written one time entry at a time, such that only a
+        # single year of details is held in memory.
+        with open(self.tidy_details_path, 'wb') as tidy_file:
+            tidy_file.write(b'[')
+            separator = b''
+            for _, pages in self.iter_years():
+                for page in pages.values():
+                    for time_entry in page['data']:
+                        tidy_file.write(separator + orjson.dumps(time_entry))
+                        separator = b','
+            tidy_file.write(b']')
+
         return self.tidy_details_path
 
+    def iter_years(self) -> Iterator[Tuple[str, YearDetails]]:
+        """Yield (year, pages) of saved detailed time entries, oldest first."""
+        for year_path in sorted(self.details_path.glob('*.json')):
+            yield year_path.stem, orjson.loads(year_path.read_bytes())
+
     @property
-    def details(self) -> DetailsDict:
-        """Retrieve detailed time entries."""
-        try:
-            return json.loads(self.details_path.read_text())
-        except FileNotFoundError:
-            return {}
+    def details(self) -> Dict[str, YearDetails]:
+        """Retrieve detailed time entries, keyed by year and page."""
+        return dict(self.iter_years())
 
     @details.setter
-    def details(self, details: DetailsDict):
+    def details(self, details: Dict[str, YearDetails]) -> None:
         """Save new detailed time entries, saving to disk."""
-        self.details_path.write_text(json.dumps(details))
+        for year, pages in details.items():
+            self.save_year(year=int(year), pages=pages)
+
+    def migrate(self, legacy_path: Path) -> None:
+        """
+        Import detailed time entries saved by earlier versions of this class.
+
+        All years used to be saved to a single JSON file, keyed by year and
+        page. The legacy file is left untouched, and can be deleted once
+        migrated.
+        """
+        self.details = orjson.loads(legacy_path.read_bytes())
+
+    def save_year(self, year: int, pages: YearDetails) -> None:
+        """
+        Save detailed time entries of a single year to disk.
+
+        Each year is stored in a separate file, such that updating the newest
+        year does not require rewriting the entire history.
+
+        :param year: Year which the time entries belong to.
+        :param pages: Paginated details for the year, keyed by page number.
+        """
+        year_path = self.details_path / f'{year}.json'
+        year_path.write_bytes(orjson.dumps(pages))
@@ -1,14 +1,21 @@
 from matplotlib import pyplot as plt
+import numpy as np
 import pandas as pd
 
 from quelf.sleepcycle import SleepCycle
 
 sc = SleepCycle()
-sleep_data: pd.DataFrame = sc.data
+sleep_data: pd.DataFrame = sc.load_json(columns=['start', 'stop'])
 
 time_slept = sleep_data['stop'] - sleep_data['start']
 
 sleep_data['time_slept'] = time_slept
 
-plt.plot(sleep_data['start'], sleep_data['time_slept'])
+# Convert to plain numpy arrays in one vectorized operation each, such that
+# matplotlib does not have to convert every data point individually. Missing
+# start or stop times become NaT and NaN, which matplotlib leaves out.
+plt.plot(
+    sleep_data['start'].to_numpy(dtype='datetime64[ns]'),
+    time_slept.dt.total_seconds().to_numpy(dtype='float64', na_value=np.nan),
+)
 plt.show()
@@ -12,3 +12,8 @@ def pytest_collection_modifyitems(config, items):
     for item in items:
         if "slow" in item.keywords:
             item.add_marker(skip_slow)
+
+@pytest.fixture(scope="session")
+def sc():
+    from quelf.sleepcycle import SleepCycle
+    return SleepCycle()
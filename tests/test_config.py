@@ -5,3 +5,7 @@ def test_retrieving_config_variable():
     config = Config('tests/test_config.yaml')
     assert config['dropbox']['app_key'] == 'testappkey'
 
+
+def test_config_file_only_parsed_once():
+    config = Config('tests/test_config.yaml')
+    assert Config('tests/test_config.yaml').yaml is config.yaml
@@ -1,13 +1,20 @@
+import io
 import json
 import os
+import random
+import time
 from pathlib import Path
+from zipfile import ZipFile
 
 import pandas as pd
 import pytest
 
+from quelf import sleepcycle
 from quelf.sleepcycle import (
     SleepSessionsCache,
     JSON_FILE,
+    PREFETCH_SIZE,
+    SLEEP_SESSION_FIELDS,
     ZIP_FILE,
     SleepCycle,
     SleepSessions,
@@ -15,46 +22,249 @@ from quelf.sleepcycle import (
 
 
 @pytest.mark.skipif(ZIP_FILE.is_file(), reason='Data already downloaded')
-def test_downloading_data_from_sleepcycle():
-    sc = SleepCycle()
+def test_downloading_data_from_sleepcycle(sc):
     sc.download_data()
     assert ZIP_FILE.is_file()
 
 
 @pytest.mark.skipif(JSON_FILE.is_file(), reason='Data already unzipped')
-def test_extraction_of_json_file():
-    sc = SleepCycle()
+def test_extraction_of_json_file(sc):
     sc.unzip_data()
     assert JSON_FILE.is_file()
 
 
-def test_importing_json_from_downloaded_data():
-    sc = SleepCycle()
+def test_importing_json_from_downloaded_data(sc):
     data = sc.load_json()
     assert isinstance(data, pd.DataFrame)
 
 
+def test_loading_selected_columns_from_parquet_cache(tmpdir, monkeypatch):
+    data_directory = Path(tmpdir)
+    zip_file_path = data_directory / 'data.zip'
+    parquet_file_path = data_directory / 'data.parquet'
+    monkeypatch.setattr(sleepcycle, 'ZIP_FILE', zip_file_path)
+    monkeypatch.setattr(sleepcycle, 'PARQUET_FILE', parquet_file_path)
+    with ZipFile(sleepcycle.ZIP_FILE, 'w') as zip_file:
+        zip_file.writestr(JSON_FILE.name, json.dumps([{
+            'start': '2018-03-31 01:09:58',
+            'stop': '2018-03-31 09:03:21',
+            'events': [[544143998.5, 1.0]],
+        }]))
+
+    data = SleepCycle().load_json()
+    assert sleepcycle.PARQUET_FILE.is_file()
+
+    # Read the columns from the now warm Parquet cache
+    sleepcycle._load_export.cache_clear()
+    selected = SleepCycle().load_json(columns=['stop', 'events'])
+    assert list(selected.columns) == ['stop', 'events']
+    assert selected['events'][0] == [[544143998.5, 1.0]]
+    assert selected.equals(data[['stop', 'events']])
+
+
+def test_loading_empty_export(tmpdir, monkeypatch):
+    data_directory = Path(tmpdir)
+    monkeypatch.setattr(sleepcycle, 'ZIP_FILE', data_directory / 'data.zip')
+    monkeypatch.setattr(
+        sleepcycle,
+        'PARQUET_FILE',
+        data_directory / 'data.parquet',
+    )
+    with ZipFile(sleepcycle.ZIP_FILE, 'w') as zip_file:
+        zip_file.writestr(JSON_FILE.name, '[]')
+
+    data = SleepCycle().load_json()
+    assert data.empty
+    assert list(data.columns) == ['start', 'stop']
+
+
 def test_lazily_loaded_data_attribute():
     sc = SleepCycle()
-    assert not hasattr(sc, '_data')
+    assert 'data' not in vars(sc)
 
     data = sc.data
-    assert hasattr(sc, '_data')
+    assert 'data' in vars(sc)
 
 
-def test_getting_latest_sleep_session_id():
-    sc = SleepCycle()
+def test_getting_latest_sleep_session_id(sc):
     assert sc.last_sleepsession_id > 0
 
 
-def test_getting_first_sleep_session_id():
-    sc = SleepCycle()
+def test_getting_first_sleep_session_id(sc):
     assert sc.first_sleepsession_id > 0
 
 
+class FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None, url=None):
+        self.status_code = status_code
+        self.url = url
+        self.content = content
+        self.headers = headers or {}
+        self.raw = io.BytesIO(content)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeExportServer:
+    """Serves an export like SleepSecure(TM), honouring conditional ranges."""
+
+    def __init__(self, export, etag, accept_ranges=False):
+        self.export = export
+        self.etag = etag
+        self.accept_ranges = accept_ranges
+        self.requests = []
+
+    def head(self, url, **kwargs):
+        headers = {'Content-Length': str(len(self.export)), 'ETag': self.etag}
+        if self.accept_ranges:
+            headers['Accept-Ranges'] = 'bytes'
+        return FakeResponse(200, headers=headers, url=url)
+
+    def get(self, url, headers=None, stream=False):
+        headers = headers or {}
+        self.requests.append(headers)
+        byte_range = headers.get('Range')
+        if byte_range and headers.get('If-Range', self.etag) == self.etag:
+            start, _, end = byte_range[len('bytes='):].partition('-')
+            stop = int(end) + 1 if end else len(self.export)
+            return FakeResponse(206, self.export[int(start):stop])
+        return FakeResponse(200, self.export, {'ETag': self.etag})
+
+
+def zipped_export(records):
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as zip_file:
+        zip_file.writestr(JSON_FILE.name, json.dumps(records))
+    return buffer.getvalue()
+
+
+class TestDownloadingData:
+    @pytest.fixture
+    def sc(self, tmpdir):
+        sc = SleepCycle()
+        sc.zip_data_path = Path(tmpdir) / 'data.zip'
+        return sc
+
+    def test_resuming_interrupted_download(self, sc):
+        export = zipped_export([{'id': 1}] * 100)
+        sc.session = FakeExportServer(export, etag='"1"')
+        part_path = Path(str(sc.zip_data_path) + '.part')
+        part_path.write_bytes(export[:100])
+        Path(str(part_path) + '.validator').write_text('"1"')
+
+        sc.download_data()
+        assert sc.zip_data_path.read_bytes() == export
+        assert sc.session.requests[-1]['Range'] == 'bytes=100-'
+        assert not part_path.exists()
+
+    def test_restarting_download_of_changed_export(self, sc):
+        old_export = zipped_export([{'id': 1}] * 100)
+        new_export = zipped_export([{'id': 2}] * 100)
+        sc.session = FakeExportServer(new_export, etag='"2"')
+        part_path = Path(str(sc.zip_data_path) + '.part')
+        part_path.write_bytes(old_export[:100])
+        Path(str(part_path) + '.validator').write_text('"1"')
+
+        sc.download_data()
+        assert sc.zip_data_path.read_bytes() == new_export
+
+    def test_downloading_ranges_in_parallel(self, sc, monkeypatch):
+        monkeypatch.setattr(sleepcycle, 'DOWNLOAD_CHUNK_SIZE', 64)
+        export = zipped_export([{'id': 1}] * 100)
+        sc.session = FakeExportServer(export, etag='"1"', accept_ranges=True)
+
+        sc.download_data()
+        assert sc.zip_data_path.read_bytes() == export
+        assert len(sc.session.requests) == -(-len(export) // 64)
+        assert all(
+            headers['If-Range'] == '"1"'
+            and headers['Accept-Encoding'] == 'identity'
+            for headers in sc.session.requests
+        )
+
+    def test_falling_back_when_export_changes_during_download(
+        self,
+        sc,
+        monkeypatch,
+    ):
+        monkeypatch.setattr(sleepcycle, 'DOWNLOAD_CHUNK_SIZE', 64)
+        old_export = zipped_export([{'id': 1}] * 100)
+        new_export = zipped_export([{'id': 2}] * 100)
+        server = FakeExportServer(old_export, etag='"1"', accept_ranges=True)
+        head = server.head
+
+        def head_before_change(url, **kwargs):
+            response = head(url, **kwargs)
+            server.export, server.etag = new_export, '"2"'
+            return response
+
+        server.head = head_before_change
+        sc.session = server
+
+        sc.download_data()
+        assert sc.zip_data_path.read_bytes() == new_export
+        assert 'Range' not in server.requests[-1]
+
+    def test_rejecting_corrupt_download(self, sc):
+        sc.session = FakeExportServer(b'<html>Log in</html>', etag='"1"')
+        with pytest.raises(ValueError):
+            sc.download_data()
+
+        assert not sc.zip_data_path.exists()
+        assert not Path(str(sc.zip_data_path) + '.part').exists()
+
+
+@pytest.fixture
+def sleep_session_json():
+    """Sleep session as returned by the SleepSecure(TM) API."""
+    return {
+        'alarm_mode': 1,
+        'graph': [[0, 93], [1, 70], [2, 42.963744904492344]],
+        'graph_date': 'Friday 30-31 Mar, 2018',
+        'graph_inbed': '01:09 - 09:03',
+        'graph_tib': '7:53',
+        'heartrate': 'n/a',
+        'id': 5856529698521088,
+        'rating': 2,
+        'seconds_from_gmt': 7200,
+        'sleep_notes': 'Drank coffee, Programming',
+        'start_global': '2018-03-30T23:09:58',
+        'start_local': '2018-03-31T01:09:58',
+        'start_tick': 544143998.51976,
+        'start_tick_tz': 'Europe/Oslo',
+        'state_mode': 2,
+        'stats_duration': 28402.9,
+        'stats_mph': 68.5158,
+        'stats_sol': 0,
+        'stats_sq': 0.816139,
+        'stats_version': 1,
+        'stats_wakeups': 0,
+        'steps': '1644 steps',
+        'stop_global': '2018-03-31T07:03:21',
+        'stop_local': '2018-03-31T09:03:21',
+        'stop_tick': 544172601.05131,
+        'stop_tick_tz': 'Europe/Oslo',
+        'window_offset_start': '2001-01-01T01:00:00',
+        'window_offset_stop': '2001-01-01T01:00:00',
+        'window_start': '2001-01-01T01:00:00',
+        'window_stop': '2001-01-01T01:00:00',
+        'xaxis': [[10.773509840509805, '02'], [23.448227299933105, '03']],
+    }
+
+
 @pytest.fixture
 def cached_sleep_sessions(tmpdir):
-    cache_path = Path(tmpdir) / 'cache.json'
+    cache_path = Path(tmpdir) / 'cache.jsonl'
     return SleepSessionsCache(json_file=cache_path)
 
 
@@ -63,10 +273,10 @@ class TestSleepSessionsCache:
         assert cached_sleep_sessions.path.is_file()
 
     def test_initial_content_being_empty_cache_structure(self, cached_sleep_sessions):
-        with open(cached_sleep_sessions.path, 'r') as cache:
-            content = json.load(cache)
+        assert cached_sleep_sessions.path.read_text() == ''
+        with open(cached_sleep_sessions.meta_path, 'r') as meta:
+            content = json.load(meta)
             assert content == {
-                'sleep_sessions': {},
                 'first_session_id': 0,
                 'newest_session_id': 0,
             }
@@ -83,22 +293,25 @@ class TestSleepSessionsCache:
 
     def test_persistence_to_disk(self, cached_sleep_sessions):
         cached_sleep_sessions[24] = '2'
+        cached_sleep_sessions.flush()
         with open(cached_sleep_sessions.path, 'r') as cache:
-            content = json.load(cache)
+            content = [json.loads(line) for line in cache]
+            assert content == [{'24': '2'}]
+        with open(cached_sleep_sessions.meta_path, 'r') as meta:
+            content = json.load(meta)
             assert content == {
-                'sleep_sessions': {'24': '2'},
                 'first_session_id': 24,
                 'newest_session_id': 24,
             }
 
         cached_sleep_sessions[1] = {'test': 'value'}
+        cached_sleep_sessions.flush()
         with open(cached_sleep_sessions.path, 'r') as cache:
-            content = json.load(cache)
+            content = [json.loads(line) for line in cache]
+            assert content == [{'24': '2'}, {'1': {'test': 'value'}}]
+        with open(cached_sleep_sessions.meta_path, 'r') as meta:
+            content = json.load(meta)
             assert content == {
-                'sleep_sessions': {
-                    '24': '2',
-                    '1': {'test': 'value'},
-                },
                 'first_session_id': 24,
                 'newest_session_id': 1,
             }
@@ -121,6 +334,7 @@ class TestSleepSessionsCache:
         assert cached_sleep_sessions.newest == '3'
         assert cached_sleep_sessions.first == '2'
 
+        cached_sleep_sessions.flush()
         cache_path = cached_sleep_sessions.path
         del cached_sleep_sessions
         new_cached_sleep_sessions = SleepSessionsCache(json_file=cache_path)
@@ -128,17 +342,111 @@ class TestSleepSessionsCache:
         assert new_cached_sleep_sessions.newest == '3'
         assert new_cached_sleep_sessions.first == '2'
 
-        with open(cache_path, 'r') as cache:
-            content = json.load(cache)
+        with open(new_cached_sleep_sessions.meta_path, 'r') as meta:
+            content = json.load(meta)
             assert content['newest_session_id'] == 1
             assert content['first_session_id'] == 10
 
+    def test_batched_writes_within_context_manager(self, cached_sleep_sessions):
+        with cached_sleep_sessions:
+            cached_sleep_sessions[24] = '2'
+            cached_sleep_sessions[1] = '3'
+            assert cached_sleep_sessions.path.read_text() == ''
+
+        with open(cached_sleep_sessions.path, 'r') as cache:
+            content = [json.loads(line) for line in cache]
+            assert content == [{'24': '2'}, {'1': '3'}]
+
+    def test_periodic_flushing(self, cached_sleep_sessions):
+        cached_sleep_sessions.FLUSH_SIZE = 2
+        cached_sleep_sessions[24] = '2'
+        assert cached_sleep_sessions.path.read_text() == ''
+
+        cached_sleep_sessions[1] = '3'
+        with open(cached_sleep_sessions.path, 'r') as cache:
+            content = [json.loads(line) for line in cache]
+            assert content == [{'24': '2'}, {'1': '3'}]
+
+    def test_only_storing_selected_fields(self, tmpdir):
+        cache = SleepSessionsCache(
+            json_file=Path(tmpdir) / 'cache.jsonl',
+            fields={'rating'},
+        )
+        cache.insert({'id': 24, 'rating': 3, 'graph': [[0, 0.5]]})
+        assert cache[24] == {'id': 24, 'rating': 3}
+
+    def test_storing_all_fields_but_graphs(self, tmpdir, sleep_session_json):
+        cache = SleepSessionsCache(
+            json_file=Path(tmpdir) / 'cache.jsonl',
+            fields=SLEEP_SESSION_FIELDS,
+        )
+        cache.insert(sleep_session_json)
+        assert set(cache[5856529698521088]) == (
+            set(sleep_session_json) - {'graph', 'xaxis'}
+        )
+
+    def test_data_frame_of_cached_sessions(
+        self,
+        cached_sleep_sessions,
+        sleep_session_json,
+    ):
+        cached_sleep_sessions.insert(sleep_session_json)
+        cached_sleep_sessions.insert({
+            **sleep_session_json,
+            'id': 1,
+            'start_local': 'n/a',
+        })
+        sleep_sessions = cached_sleep_sessions.to_dataframe()
+
+        assert sleep_sessions['id'].tolist() == [5856529698521088, 1]
+        assert sleep_sessions['id'].dtype == 'Int64'
+        assert sleep_sessions['rating'].dtype == 'Int8'
+        assert sleep_sessions['stats_duration'].iloc[0] == 28402.9
+        assert sleep_sessions['start_local'].iloc[0] == pd.Timestamp(
+            '2018-03-31T01:09:58',
+        )
+        assert pd.isna(sleep_sessions['start_local'].iloc[1])
+        assert cached_sleep_sessions.to_dataframe() is sleep_sessions
+
+    def test_migrating_legacy_json_cache(self, tmpdir):
+        legacy_path = Path(tmpdir) / 'cache.json'
+        legacy_path.write_text(json.dumps({
+            'sleep_sessions': {'24': '2', '1': '3'},
+            'newest_session_id': '1',
+            'first_session_id': '24',
+        }))
+
+        cache = SleepSessionsCache(json_file=Path(tmpdir) / 'cache.jsonl')
+        assert cache[24] == '2'
+        assert cache.newest == '3'
+        assert cache.first == '2'
+
+        new_cache = SleepSessionsCache(json_file=cache.path)
+        assert new_cache[1] == '3'
+        assert new_cache.newest == '3'
+
+    def test_compacting_superseded_sessions(self, cached_sleep_sessions):
+        cached_sleep_sessions[24] = '1'
+        cached_sleep_sessions.flush()
+        cached_sleep_sessions[24] = '2'
+        cached_sleep_sessions.flush()
+        assert cached_sleep_sessions.path.read_text().count('\n') == 2
+
+        cached_sleep_sessions[24] = '3'
+        cached_sleep_sessions.flush()
+        with open(cached_sleep_sessions.path, 'r') as cache:
+            content = [json.loads(line) for line in cache]
+            assert content == [{'24': '3'}]
+
+        new_cache = SleepSessionsCache(json_file=cached_sleep_sessions.path)
+        assert new_cache[24] == '3'
+        assert new_cache.superseded == 0
+
 
 
 
 @pytest.fixture
-def sleep_sessions():
-    sc = SleepCycle()
+def sleep_sessions(sc):
     return SleepSessions(
         first_sleepsession_id=sc.first_sleepsession_id,
         last_sleepsession_id=sc.last_sleepsession_id,
@@ -147,8 +455,98 @@ def sleep_sessions():
 
 
 class TestSleepSessions:
-    def test_updating_sleep_session_cache(self, sleep_sessions):
-        sc = SleepCycle()
+    def test_updating_sleep_session_cache(self, sc, sleep_sessions):
         sleep_sessions.update_cache(total_items=len(sc))
         assert 0 not in sleep_sessions.cache
         assert len(sc) == len(sleep_sessions) - 1  # TODO
+
+
+class FakeSleepSecure:
+    """Serves a chain of sleep sessions linked by the next/prev parameters."""
+
+    def __init__(self, session_ids, failing_direction=None, seed=42):
+        self.session_ids = session_ids
+        self.failing_direction = failing_direction
+        self.requests = 0
+        self.random = random.Random(seed)
+
+    def get(self, url, params):
+        self.requests += 1
+        time.sleep(self.random.random() / 1000)
+        if self.failing_direction in params:
+            raise ConnectionError('SleepSecure(TM) is unavailable')
+
+        index = self.session_ids.index(int(params['id']))
+        if 'next' in params:
+            index += 1
+        elif 'prev' in params:
+            index -= 1
+        if not 0 <= index < len(self.session_ids):
+            return FakeResponse(200, b'<html>Not found</html>')
+
+        session_id = self.session_ids[index]
+        return FakeResponse(
+            200,
+            json.dumps({'id': session_id, 'rating': session_id % 4}).encode(),
+        )
+
+
+class TestWalkingSleepSessions:
+    @pytest.fixture
+    def session_ids(self):
+        # Opaque, unordered IDs, as SleepSecure(TM) uses datastore keys
+        return random.Random(42).sample(range(1, 10 ** 12), 200)
+
+    def sleep_sessions(self, tmpdir, session_ids, **kwargs):
+        return SleepSessions(
+            first_sleepsession_id=session_ids[0],
+            last_sleepsession_id=session_ids[-1],
+            session=FakeSleepSecure(session_ids, **kwargs),
+            cache=SleepSessionsCache(json_file=Path(tmpdir) / 'cache.jsonl'),
+        )
+
+    def test_walking_the_chain_from_both_ends(self, tmpdir, session_ids):
+        for _ in range(5):
+            tmpdir = tmpdir.mkdtemp()
+            sleep_sessions = self.sleep_sessions(tmpdir, session_ids)
+            sleep_sessions.update_cache()
+
+            cache = sleep_sessions.cache
+            assert list(cache.memory['sleep_sessions']) == session_ids
+            assert cache.first['id'] == session_ids[0]
+            assert cache.newest['id'] == session_ids[-1]
+
+            reloaded_cache = SleepSessionsCache(json_file=cache.path)
+            assert list(reloaded_cache.memory['sleep_sessions']) == session_ids
+            assert reloaded_cache.newest['id'] == session_ids[-1]
+
+    def test_continuing_partially_cached_chain(self, tmpdir, session_ids):
+        sleep_sessions = self.sleep_sessions(tmpdir, session_ids[:120])
+        sleep_sessions.update_cache()
+
+        sleep_sessions = self.sleep_sessions(tmpdir, session_ids)
+        sleep_sessions.update_cache()
+        cache = sleep_sessions.cache
+        assert list(cache.memory['sleep_sessions']) == session_ids
+        assert cache.newest['id'] == session_ids[-1]
+
+    def test_aborting_prefetch_stops_walking(self, tmpdir, session_ids):
+        sleep_sessions = self.sleep_sessions(tmpdir, session_ids)
+        prefetched = sleep_sessions.prefetch(session_id=session_ids[0])
+        for _ in range(3):
+            next(prefetched)
+        prefetched.close()
+
+        # At most the queued sessions and the one being put are fetched
+        assert sleep_sessions.session.requests <= 3 + PREFETCH_SIZE + 2
+        assert sleep_sessions.session.requests < len(session_ids) - 1
+
+    def test_ignoring_failed_backward_walk(self, tmpdir, session_ids):
+        sleep_sessions = self.sleep_sessions(
+            tmpdir,
+            session_ids,
+            failing_direction='prev',
+        )
+        sleep_sessions.update_cache()
+        cache = sleep_sessions.cache
+        assert list(cache.memory['sleep_sessions']) == session_ids